@@ -0,0 +1,24 @@
+"""
+Gunicorn configuration for the Ansible Agent relay service
+
+The relay spends most of each request waiting on AWX, so threaded workers
+keep many requests in flight per process.
+"""
+
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+worker_class = 'gthread'
+workers = int(os.getenv('GUNICORN_WORKERS', '2'))
+threads = int(os.getenv('GUNICORN_THREADS', '32'))
+timeout = 120
+keepalive = 75
+
+# Heartbeat files go to memory, the container root filesystem is read-only
+worker_tmp_dir = '/dev/shm'
+
+def post_fork(server, worker):
+    """Give each worker its own AWX connection pool when the app is preloaded"""
+    if server.cfg.preload_app:
+        from ansible_agent import app as agent_app
+        agent_app.reset_awx_session()
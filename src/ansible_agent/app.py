@@ -4,29 +4,50 @@ Ansible Agent - AWX Relay Service
 A lightweight Python service that receives hostname callbacks and triggers AWX workflows
 """
 
+import base64
 import os
 import re
 import hashlib
 import logging
+import socket
 import time
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Tuple
 
+import orjson
 import requests
-from flask import Flask, request, jsonify
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import Flask, Response, request, jsonify, g
+from flask.json.provider import DefaultJSONProvider
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
+from limits import parse_many
+from werkzeug.exceptions import HTTPException, RequestEntityTooLarge, TooManyRequests
 from dotenv import load_dotenv
 import redis
 
 # Load environment variables
 load_dotenv()
 
+class ORJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider that serializes responses with orjson"""
+    
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        """Serialize data as JSON, honouring Flask's sort_keys and indent settings"""
+        option = orjson.OPT_NON_STR_KEYS
+        if kwargs.get('sort_keys', self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get('indent'):
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=kwargs.get('default', self.default), option=option).decode()
+
 # Initialize Flask app
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 
 # Configure logging
 logging.basicConfig(
-    level=logging.INFO,
+    level=os.getenv('LOG_LEVEL', 'INFO').upper(),
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
@@ -35,16 +56,26 @@ logger = logging.getLogger(__name__)
 redis_client = None
 try:
     redis_url = os.getenv('REDIS_URL', 'redis://localhost:6379')
-    redis_client = redis.from_url(redis_url)
+    # Blocking pool waits briefly for a free connection instead of failing when exhausted
+    redis_pool = redis.BlockingConnectionPool.from_url(
+        redis_url,
+        max_connections=int(os.getenv('REDIS_MAX_CONNECTIONS', '64')),
+        timeout=1.0,
+        socket_keepalive=True
+    )
+    redis_client = redis.Redis(connection_pool=redis_pool)
     redis_client.ping()
     logger.info("Connected to Redis for rate limiting")
 except Exception as e:
-    logger.warning(f"Redis connection failed, using in-memory rate limiting: {e}")
+    redis_client = None
+    logger.warning("Redis connection failed, using in-memory rate limiting: %s", e)
 
 # Initialize rate limiter
+# Limits are enforced by the Redis script below, flask-limiter only applies
+# them in memory when Redis is unavailable
 limiter = Limiter(
     key_func=get_remote_address,
-    storage_uri=redis_url if redis_client else None,
+    storage_uri='memory://',
     default_limits=[]
 )
 limiter.init_app(app)
@@ -65,6 +96,13 @@ class Config:
     # Security configuration
     MAX_HOSTNAME_LENGTH = int(os.getenv('MAX_HOSTNAME_LENGTH', '253'))
     MIN_HOSTNAME_LENGTH = int(os.getenv('MIN_HOSTNAME_LENGTH', '1'))
+    MAX_CONTENT_LENGTH = int(os.getenv('MAX_CONTENT_LENGTH', '1024'))
+    
+    # AWX lookup caching (seconds)
+    AWX_ID_CACHE_TTL = int(os.getenv('AWX_ID_CACHE_TTL', '600'))
+    
+    # AWX connection pool size, should cover the concurrent requests per process
+    AWX_POOL_MAXSIZE = int(os.getenv('AWX_POOL_MAXSIZE', '50'))
     
     @classmethod
     def validate(cls):
@@ -86,10 +124,88 @@ try:
     Config.validate()
     logger.info("Configuration validation passed")
 except ValueError as e:
-    logger.warning(f"Configuration validation failed: {e}")
+    logger.warning("Configuration validation failed: %s", e)
     if os.getenv('FLASK_ENV') != 'development':
         raise
 
+# Configuration is fixed for the process lifetime, bind hot-path values once
+_AWX_ENDPOINT = Config.AWX_API_ENDPOINT
+_TEMPLATE_NAME = Config.AWX_TEMPLATE_NAME
+_WORKFLOW_NAME = Config.AWX_WORKFLOW_NAME
+_MIN_LEN = Config.MIN_HOSTNAME_LENGTH
+_MAX_LEN = Config.MAX_HOSTNAME_LENGTH
+
+# Werkzeug enforces the body size limit on the request stream: a larger
+# Content-Length is rejected with 413, and chunked bodies without one are
+# never read past the limit
+app.config['MAX_CONTENT_LENGTH'] = Config.MAX_CONTENT_LENGTH
+
+# Check and count all rate limits atomically in a single Redis round-trip
+# KEYS: one counter per limit
+# ARGV: limit and window (seconds) for each key, in the same order
+# Returns: {allowed, retry_after}
+RATE_LIMIT_SCRIPT = """
+for i, key in ipairs(KEYS) do
+    local count = tonumber(redis.call('GET', key) or '0')
+    if count >= tonumber(ARGV[2 * i - 1]) then
+        return {0, redis.call('TTL', key)}
+    end
+end
+for i, key in ipairs(KEYS) do
+    if redis.call('INCR', key) == 1 then
+        redis.call('EXPIRE', key, ARGV[2 * i])
+    end
+end
+return {1, 0}
+"""
+
+# Each setting may hold several limits separated by ';', all of them apply
+PER_IP_LIMITS = parse_many(Config.PER_IP_RATE_LIMIT)
+GLOBAL_LIMITS = parse_many(Config.GLOBAL_RATE_LIMIT)
+rate_limit_script = redis_client.register_script(RATE_LIMIT_SCRIPT) if redis_client else None
+
+@app.before_request
+def enforce_rate_limits():
+    """
+    Apply per-IP and global rate limits to /provision via the Redis script
+    
+    If Redis is unavailable the request is left to the in-memory
+    flask-limiter limits on the endpoint.
+    """
+    if request.endpoint != 'provision' or rate_limit_script is None:
+        return None
+    
+    client_ip = get_remote_address()
+    scoped_limits = [(f'ip:{client_ip}', item) for item in PER_IP_LIMITS]
+    scoped_limits += [('global', item) for item in GLOBAL_LIMITS]
+    
+    keys, args = [], []
+    for scope, item in scoped_limits:
+        keys.append(f'ansible-agent:ratelimit:{scope}:{item.amount}/{item.get_expiry()}')
+        args += [item.amount, item.get_expiry()]
+    
+    try:
+        allowed, retry_after = rate_limit_script(keys=keys, args=args)
+    except redis.exceptions.RedisError as e:
+        logger.warning("Redis rate limiting failed, using in-memory rate limiting: %s", e)
+        return None
+    
+    g.redis_rate_limited = True
+    if not allowed:
+        raise TooManyRequests(retry_after=retry_after)
+    return None
+
+def redis_rate_limited() -> bool:
+    """Whether the current request was already rate limited through Redis"""
+    return g.get('redis_rate_limited', False)
+
+# RFC 1123 compliant hostname pattern, matched against the lowercased hostname
+# Allow letters, numbers, hyphens, and dots
+# Every label must start and end with alphanumeric characters, which also
+# rules out consecutive dots and leading/trailing hyphens
+# Groups are non-capturing since only the match result is used
+_HOSTNAME_RE = re.compile(r'[a-z0-9](?:[a-z0-9\-]{0,61}[a-z0-9])?(?:\.[a-z0-9](?:[a-z0-9\-]{0,61}[a-z0-9])?)*')
+
 def sanitize_hostname(hostname: str) -> Optional[str]:
     """
     Sanitize and validate hostname according to RFC standards
@@ -103,36 +219,29 @@ def sanitize_hostname(hostname: str) -> Optional[str]:
     if not hostname:
         return None
     
+    # Reject oversized input before copying it, allowing for surrounding whitespace
+    if len(hostname) > _MAX_LEN + 16:
+        logger.warning("Hostname length invalid: %d characters", len(hostname))
+        return None
+    
+    # Hostnames are ASCII only, rejecting anything else up front also keeps
+    # characters such as the Kelvin sign from lowercasing into valid ASCII
+    if not hostname.isascii():
+        logger.warning("Hostname contains non-ASCII characters: %r", hostname)
+        return None
+    
     # Remove whitespace and convert to lowercase
     hostname = hostname.strip().lower()
     
     # Check length constraints
-    if len(hostname) < Config.MIN_HOSTNAME_LENGTH or len(hostname) > Config.MAX_HOSTNAME_LENGTH:
-        logger.warning(f"Hostname length invalid: {len(hostname)} characters")
+    if len(hostname) < _MIN_LEN or len(hostname) > _MAX_LEN:
+        logger.warning("Hostname length invalid: %d characters", len(hostname))
         return None
     
-    # RFC 1123 compliant hostname pattern
-    # Allow letters, numbers, hyphens, and dots
-    # Must start and end with alphanumeric characters
-    hostname_pattern = r'^[a-zA-Z0-9]([a-zA-Z0-9\-]{0,61}[a-zA-Z0-9])?(\.[a-zA-Z0-9]([a-zA-Z0-9\-]{0,61}[a-zA-Z0-9])?)*$'
-    
-    if not re.match(hostname_pattern, hostname):
-        logger.warning(f"Hostname does not match RFC 1123 pattern: {hostname}")
+    if not _HOSTNAME_RE.fullmatch(hostname):
+        logger.warning("Hostname does not match RFC 1123 pattern: %s", hostname)
         return None
     
-    # Additional security checks - reject suspicious patterns
-    suspicious_patterns = [
-        r'\.\.+',  # Multiple consecutive dots
-        r'^-',     # Starting with hyphen
-        r'-$',     # Ending with hyphen
-        r'[^a-zA-Z0-9\.-]',  # Invalid characters
-    ]
-    
-    for pattern in suspicious_patterns:
-        if re.search(pattern, hostname):
-            logger.warning(f"Hostname contains suspicious pattern: {hostname}")
-            return None
-    
     return hostname
 
 def get_awx_auth_headers() -> Dict[str, str]:
@@ -140,10 +249,140 @@ def get_awx_auth_headers() -> Dict[str, str]:
     if Config.AWX_TOKEN:
         return {'Authorization': f'Bearer {Config.AWX_TOKEN}'}
     else:
-        import base64
         credentials = base64.b64encode(f"{Config.AWX_USERNAME}:{Config.AWX_PASSWORD}".encode()).decode()
         return {'Authorization': f'Basic {credentials}'}
 
+# Headers sent with every AWX API call, built once since credentials are static
+_AWX_HEADERS = {
+    'Content-Type': 'application/json',
+    **get_awx_auth_headers()
+}
+
+class AWXHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter that disables Nagle and enables TCP keepalive on AWX connections"""
+    
+    socket_options = [
+        (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+        (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+    ]
+    
+    def init_poolmanager(self, *args: Any, **kwargs: Any) -> None:
+        kwargs['socket_options'] = self.socket_options
+        super().init_poolmanager(*args, **kwargs)
+    
+    def proxy_manager_for(self, proxy: str, **proxy_kwargs: Any) -> Any:
+        proxy_kwargs['socket_options'] = self.socket_options
+        return super().proxy_manager_for(proxy, **proxy_kwargs)
+
+def create_awx_session() -> requests.Session:
+    """
+    Create a pooled HTTP session for AWX API calls
+    
+    Reusing one session keeps connections to AWX alive between requests,
+    so only the first call pays the TCP and TLS handshake.
+    
+    Returns:
+        Session with retrying adapter and AWX headers attached
+    """
+    session = requests.Session()
+    adapter = AWXHTTPAdapter(
+        pool_connections=10,
+        pool_maxsize=Config.AWX_POOL_MAXSIZE,
+        max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=[502, 503, 504])
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update(_AWX_HEADERS)
+    return session
+
+# Shared AWX session, rebuilt per worker process by reset_awx_session()
+awx_session = create_awx_session()
+
+def reset_awx_session() -> None:
+    """Replace the shared AWX session so a forked process does not reuse inherited sockets"""
+    global awx_session
+    awx_session = create_awx_session()
+
+# AWX API collection for each launchable kind
+AWX_API_PATHS = {
+    'template': 'job_templates',
+    'workflow': 'workflow_job_templates',
+}
+
+# Collection URL for each launchable kind
+_AWX_COLLECTION_URLS = {kind: f"{_AWX_ENDPOINT}/api/v2/{path}/" for kind, path in AWX_API_PATHS.items()}
+
+# The configured launch target
+_AWX_KIND, _AWX_NAME = ('template', _TEMPLATE_NAME) if _TEMPLATE_NAME else ('workflow', _WORKFLOW_NAME)
+
+# Resolved AWX IDs and launch URLs keyed by (kind, name), stored with their expiry time
+_awx_id_cache: Dict[Tuple[str, str], Tuple[int, str, float]] = {}
+
+def _resolve_launch_target(kind: str, name: str, session: Optional[requests.Session] = None,
+                           timeout: float = 10) -> Optional[Tuple[int, str, bool]]:
+    """
+    Resolve an AWX template or workflow name to its ID and launch URL
+    
+    Lookups are cached for Config.AWX_ID_CACHE_TTL seconds so the
+    provisioning path only has to POST the launch request.
+    
+    Args:
+        kind: Either 'template' or 'workflow'
+        name: Name of the template or workflow in AWX
+        session: Session for the lookup, defaults to the shared AWX session
+        timeout: Lookup timeout in seconds
+        
+    Returns:
+        Tuple of AWX ID, launch URL and whether it came from the cache if found,
+        None if no match exists
+    """
+    cached = _awx_id_cache.get((kind, name))
+    if cached and time.monotonic() < cached[2]:
+        return cached[0], cached[1], True
+    
+    response = (session or awx_session).get(_AWX_COLLECTION_URLS[kind], params={'name': name}, timeout=timeout)
+    response.raise_for_status()
+    
+    results = response.json().get('results', [])
+    if not results:
+        return None
+    
+    awx_id = results[0]['id']
+    launch_url = f"{_AWX_COLLECTION_URLS[kind]}{awx_id}/launch/"
+    _awx_id_cache[(kind, name)] = (awx_id, launch_url, time.monotonic() + Config.AWX_ID_CACHE_TTL)
+    return awx_id, launch_url, False
+
+# Startup lookup timeout, kept short so an unreachable AWX does not stall worker boot
+_AWX_PRELOAD_TIMEOUT = 3
+
+def preload_awx_id() -> None:
+    """
+    Resolve the configured template or workflow ID ahead of the first request
+    
+    Uses a plain session without retries and a short timeout. Failures are
+    only logged, the lookup is retried on the request path.
+    """
+    if not _AWX_NAME:
+        return
+    
+    try:
+        with requests.Session() as session:
+            session.headers.update(_AWX_HEADERS)
+            target = _resolve_launch_target(_AWX_KIND, _AWX_NAME, session=session,
+                                            timeout=_AWX_PRELOAD_TIMEOUT)
+    except requests.exceptions.RequestException as e:
+        logger.warning("Could not resolve AWX %s '%s' at startup: %s", _AWX_KIND, _AWX_NAME, e)
+        return
+    
+    if target is None:
+        logger.warning("AWX %s '%s' not found at startup", _AWX_KIND, _AWX_NAME)
+    else:
+        logger.info("Resolved AWX %s '%s' to ID %s", _AWX_KIND, _AWX_NAME, target[0])
+
+# Resolve the launch target at startup so requests only need the launch POST
+if os.getenv('FLASK_ENV') != 'development':
+    preload_awx_id()
+
 def trigger_awx_job(hostname: str) -> Dict[str, Any]:
     """
     Trigger AWX job template or workflow with hostname limit
@@ -154,132 +393,102 @@ def trigger_awx_job(hostname: str) -> Dict[str, Any]:
     Returns:
         Dictionary with success status and job details
     """
-    headers = {
-        'Content-Type': 'application/json',
-        **get_awx_auth_headers()
-    }
+    kind, name = _AWX_KIND, _AWX_NAME
+    
+    # Only reachable in development, where configuration validation is not enforced
+    if not name:
+        logger.error("No AWX template or workflow name configured")
+        return {'success': False, 'error': 'No AWX template or workflow configured'}
+    
+    # Serialized once up front, the session already sends the JSON Content-Type
+    payload = orjson.dumps({
+        'limit': hostname,
+        'extra_vars': {
+            'target_hostname': hostname
+        }
+    })
     
     try:
-        if Config.AWX_TEMPLATE_NAME:
-            # Launch job template
-            url = f"{Config.AWX_API_ENDPOINT}/api/v2/job_templates/"
-            
-            # First, find the template ID
-            response = requests.get(f"{url}?name={Config.AWX_TEMPLATE_NAME}", headers=headers, timeout=10)
-            response.raise_for_status()
-            
-            templates = response.json().get('results', [])
-            if not templates:
-                logger.error(f"Template '{Config.AWX_TEMPLATE_NAME}' not found")
-                return {'success': False, 'error': 'Template not found'}
-            
-            template_id = templates[0]['id']
-            
-            # Launch the template with hostname limit
-            launch_url = f"{url}{template_id}/launch/"
-            payload = {
-                'limit': hostname,
-                'extra_vars': {
-                    'target_hostname': hostname
-                }
-            }
-            
-            response = requests.post(launch_url, json=payload, headers=headers, timeout=10)
-            response.raise_for_status()
-            
-            job_data = response.json()
-            logger.info(f"Launched job template {template_id} for {hostname}, job ID: {job_data.get('id')}")
-            
-            return {
-                'success': True,
-                'job_id': job_data.get('id'),
-                'job_type': 'template',
-                'hostname': hostname
-            }
-            
-        elif Config.AWX_WORKFLOW_NAME:
-            # Launch workflow template
-            url = f"{Config.AWX_API_ENDPOINT}/api/v2/workflow_job_templates/"
-            
-            # First, find the workflow ID
-            response = requests.get(f"{url}?name={Config.AWX_WORKFLOW_NAME}", headers=headers, timeout=10)
-            response.raise_for_status()
-            
-            workflows = response.json().get('results', [])
-            if not workflows:
-                logger.error(f"Workflow '{Config.AWX_WORKFLOW_NAME}' not found")
-                return {'success': False, 'error': 'Workflow not found'}
+        target = _resolve_launch_target(kind, name)
+        while True:
+            if target is None:
+                logger.error("%s '%s' not found", kind.capitalize(), name)
+                return {'success': False, 'error': f'{kind.capitalize()} not found'}
             
-            workflow_id = workflows[0]['id']
+            # Launch with hostname limit
+            awx_id, launch_url, from_cache = target
+            response = awx_session.post(launch_url, data=payload, timeout=10)
             
-            # Launch the workflow with hostname limit
-            launch_url = f"{url}{workflow_id}/launch/"
-            payload = {
-                'limit': hostname,
-                'extra_vars': {
-                    'target_hostname': hostname
-                }
-            }
-            
-            response = requests.post(launch_url, json=payload, headers=headers, timeout=10)
-            response.raise_for_status()
-            
-            job_data = response.json()
-            logger.info(f"Launched workflow {workflow_id} for {hostname}, job ID: {job_data.get('id')}")
-            
-            return {
-                'success': True,
-                'job_id': job_data.get('id'),
-                'job_type': 'workflow',
-                'hostname': hostname
-            }
+            # A 404 for a cached ID means it is stale (recreated in AWX), look it up
+            # again; a fresh lookup is never retried, so this happens at most once
+            if response.status_code != 404 or not from_cache:
+                break
+            _awx_id_cache.pop((kind, name), None)
+            target = _resolve_launch_target(kind, name)
+        
+        response.raise_for_status()
+        
+        job_data = response.json()
+        logger.info("Launched %s %s for %s, job ID: %s", kind, awx_id, hostname, job_data.get('id'))
+        
+        return {
+            'success': True,
+            'job_id': job_data.get('id'),
+            'job_type': kind,
+            'hostname': hostname
+        }
     
     except requests.exceptions.Timeout:
-        logger.error(f"AWX API timeout for hostname {hostname}")
+        logger.error("AWX API timeout for hostname %s", hostname)
         return {'success': False, 'error': 'AWX API timeout'}
     
     except requests.exceptions.RequestException as e:
-        logger.error(f"AWX API error for hostname {hostname}: {e}")
+        logger.error("AWX API error for hostname %s: %s", hostname, e)
         return {'success': False, 'error': f'AWX API error: {str(e)}'}
     
     except Exception as e:
-        logger.error(f"Unexpected error triggering AWX job for {hostname}: {e}")
+        logger.error("Unexpected error triggering AWX job for %s: %s", hostname, e)
         return {'success': False, 'error': f'Unexpected error: {str(e)}'}
 
+# Encoded /health body and the time it was built, refreshed at most once per second
+_HEALTH_CACHE = [0.0, b'']
+
 @app.route('/health', methods=['GET'])
+@limiter.exempt
 def health_check():
     """Health check endpoint"""
-    return jsonify({'status': 'healthy', 'timestamp': time.time()})
+    now = time.time()
+    if now - _HEALTH_CACHE[0] > 1.0:
+        _HEALTH_CACHE[:] = [now, orjson.dumps({'status': 'healthy', 'timestamp': now})]
+    return Response(_HEALTH_CACHE[1], mimetype='application/json')
 
 @app.route('/provision', methods=['POST'])
-@limiter.limit(Config.PER_IP_RATE_LIMIT)
-@limiter.limit(Config.GLOBAL_RATE_LIMIT, key_func=lambda: 'global')
+@limiter.limit(Config.PER_IP_RATE_LIMIT, exempt_when=redis_rate_limited)
+@limiter.limit(Config.GLOBAL_RATE_LIMIT, key_func=lambda: 'global', exempt_when=redis_rate_limited)
 def provision():
     """
     Main provisioning endpoint
     Accepts hostname and triggers AWX job
     """
     try:
-        # Extract hostname from request
-        if request.is_json:
-            data = request.get_json()
-            hostname = data.get('hostname') if data else None
-        else:
-            hostname = request.form.get('hostname')
+        # Extract hostname from a JSON body, falling back to form data
+        data = request.get_json(silent=True, cache=False) or request.form
+        hostname = data.get('hostname') if data else None
         
-        if not hostname:
+        # An empty hostname is present but invalid, only a missing one is required
+        if hostname is None:
             logger.warning("Missing hostname in request")
             return jsonify({'error': 'hostname parameter is required'}), 400
         
         # Sanitize hostname
         sanitized_hostname = sanitize_hostname(hostname)
         if not sanitized_hostname:
-            logger.warning(f"Invalid hostname rejected: {hostname}")
+            logger.warning("Invalid hostname rejected: %s", hostname)
             return jsonify({'error': 'Invalid hostname format'}), 400
         
         # Log the request
         client_ip = get_remote_address()
-        logger.info(f"Provisioning request from {client_ip} for hostname: {sanitized_hostname}")
+        logger.info("Provisioning request from %s for hostname: %s", client_ip, sanitized_hostname)
         
         # Trigger AWX job
         result = trigger_awx_job(sanitized_hostname)
@@ -299,15 +508,25 @@ def provision():
                 'error': result.get('error')
             }), 500
     
+    except HTTPException:
+        # Let Flask route these to their error handlers (e.g. oversized bodies)
+        raise
+    
     except Exception as e:
-        logger.error(f"Unexpected error in provision endpoint: {e}")
+        logger.error("Unexpected error in provision endpoint: %s", e)
         return jsonify({'error': 'Internal server error'}), 500
 
+@app.errorhandler(RequestEntityTooLarge)
+def request_too_large_handler(e):
+    """Request body size error handler"""
+    logger.warning("Request body too large from IP: %s", get_remote_address())
+    return jsonify({'error': 'Request body too large'}), 413
+
 @app.errorhandler(429)
 def ratelimit_handler(e):
     """Rate limit error handler"""
     client_ip = get_remote_address()
-    logger.warning(f"Rate limit exceeded for IP: {client_ip}")
+    logger.warning("Rate limit exceeded for IP: %s", client_ip)
     return jsonify({
         'error': 'Rate limit exceeded',
         'message': 'Too many requests. Please try again later.',
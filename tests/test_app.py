@@ -1,7 +1,9 @@
 import pytest
 import json
 import os
+import requests
 from unittest.mock import patch, MagicMock
+from limits import parse_many
 
 # Set environment variables for testing
 os.environ['FLASK_ENV'] = 'development'
@@ -10,13 +12,24 @@ os.environ['AWX_USERNAME'] = 'test'
 os.environ['AWX_PASSWORD'] = 'test'
 os.environ['AWX_TEMPLATE_NAME'] = 'test-template'
 
-from ansible_agent.app import app, sanitize_hostname
+from ansible_agent.app import (
+    app, limiter, sanitize_hostname, trigger_awx_job, preload_awx_id, _awx_id_cache, _HOSTNAME_RE
+)
 
 @pytest.fixture
 def client():
+    limiter.reset()
     with app.test_client() as client:
         yield client
 
+@pytest.fixture
+def awx_session():
+    _awx_id_cache.clear()
+    with patch('ansible_agent.app.awx_session') as session:
+        session.get.return_value.json.return_value = {'results': [{'id': 7}]}
+        session.post.return_value.json.return_value = {'id': 42}
+        yield session
+
 def test_health_endpoint(client):
     """Test the health check endpoint"""
     response = client.get('/health')
@@ -25,6 +38,14 @@ def test_health_endpoint(client):
     assert data['status'] == 'healthy'
     assert 'timestamp' in data
 
+def test_health_endpoint_reuses_cached_body(client):
+    """Test repeated health checks within a second share one encoded body"""
+    first = client.get('/health')
+    second = client.get('/health')
+    assert second.status_code == 200
+    assert second.mimetype == 'application/json'
+    assert first.data == second.data
+
 def test_provision_missing_hostname(client):
     """Test provision endpoint with missing hostname"""
     response = client.post('/provision', json={})
@@ -45,6 +66,7 @@ def test_provision_invalid_hostname(client):
     ]
     
     for hostname in invalid_hostnames:
+        limiter.reset()  # Each case is its own request, keep the per-IP limit out of the way
         response = client.post('/provision', json={'hostname': hostname})
         assert response.status_code == 400
         data = json.loads(response.data)
@@ -67,6 +89,67 @@ def test_provision_valid_hostname(mock_trigger, client):
     assert data['hostname'] == 'testhost.example.com'
     assert data['job_id'] == 123
 
+@patch('ansible_agent.app.trigger_awx_job')
+@patch('ansible_agent.app.rate_limit_script')
+def test_provision_redis_rate_limit_allows(mock_script, mock_trigger, client):
+    """Test requests allowed by the Redis script skip the in-memory limits"""
+    mock_script.return_value = [1, 0]
+    mock_trigger.return_value = {'success': True, 'job_id': 123, 'job_type': 'template'}
+    
+    for _ in range(3):
+        response = client.post('/provision', json={'hostname': 'testhost.example.com'})
+        assert response.status_code == 200
+    
+    assert mock_script.call_count == 3
+
+@patch('ansible_agent.app.trigger_awx_job')
+@patch('ansible_agent.app.rate_limit_script')
+def test_provision_redis_rate_limit_exceeded(mock_script, mock_trigger, client):
+    """Test requests rejected by the Redis script return 429"""
+    mock_script.return_value = [0, 120]
+    
+    response = client.post('/provision', json={'hostname': 'testhost.example.com'})
+    assert response.status_code == 429
+    data = json.loads(response.data)
+    assert data['error'] == 'Rate limit exceeded'
+    assert data['retry_after'] == 120
+    mock_trigger.assert_not_called()
+
+@patch('ansible_agent.app.GLOBAL_LIMITS', parse_many('100 per hour'))
+@patch('ansible_agent.app.PER_IP_LIMITS', parse_many('1 per minute;10 per hour'))
+@patch('ansible_agent.app.trigger_awx_job')
+@patch('ansible_agent.app.rate_limit_script')
+def test_provision_redis_rate_limit_checks_every_limit(mock_script, mock_trigger, client):
+    """Test every limit in a multi-limit setting is passed to the Redis script"""
+    mock_script.return_value = [1, 0]
+    mock_trigger.return_value = {'success': True, 'job_id': 123, 'job_type': 'template'}
+    
+    response = client.post('/provision', json={'hostname': 'testhost.example.com'})
+    assert response.status_code == 200
+    
+    keys = mock_script.call_args[1]['keys']
+    args = mock_script.call_args[1]['args']
+    assert len(keys) == 3
+    assert len(set(keys)) == 3
+    assert args == [1, 60, 10, 3600, 100, 3600]
+
+@patch('ansible_agent.app.trigger_awx_job')
+def test_provision_form_hostname(mock_trigger, client):
+    """Test provision endpoint accepts form-encoded hostname"""
+    mock_trigger.return_value = {'success': True, 'job_id': 123, 'job_type': 'template'}
+    
+    response = client.post('/provision', data={'hostname': 'testhost.example.com'})
+    assert response.status_code == 200
+    data = json.loads(response.data)
+    assert data['hostname'] == 'testhost.example.com'
+
+def test_provision_body_too_large(client):
+    """Test provision endpoint rejects oversized bodies before parsing"""
+    response = client.post('/provision', json={'hostname': 'a' * 2048})
+    assert response.status_code == 413
+    data = json.loads(response.data)
+    assert 'Request body too large' in data['error']
+
 def test_sanitize_hostname():
     """Test hostname sanitization function"""
     # Valid hostnames
@@ -84,4 +167,101 @@ def test_sanitize_hostname():
     assert sanitize_hostname('-hostname') is None
     assert sanitize_hostname('hostname-') is None
     assert sanitize_hostname('host name') is None
-    assert sanitize_hostname('host@name') is None
\ No newline at end of file
+    assert sanitize_hostname('host@name') is None
+    assert sanitize_hostname('h\u00f6st.example.com') is None  # Non-ASCII
+    assert sanitize_hostname('\u212aube.example.com') is None  # Kelvin sign lowercases to 'k'
+
+def test_hostname_pattern_rejects_suspicious_hostnames():
+    """Test the RFC 1123 pattern alone rejects the suspicious cases"""
+    suspicious_hostnames = [
+        'host..name',  # Double dots
+        '.hostname',  # Empty leading label
+        'hostname.',  # Empty trailing label
+        '-hostname',  # Starts with hyphen
+        'hostname-',  # Ends with hyphen
+        'host.-name',  # Label starts with hyphen
+        'host name',  # Space
+        'host@name',  # Invalid character
+        'hostname\n',  # Trailing newline
+    ]
+    
+    for hostname in suspicious_hostnames:
+        assert _HOSTNAME_RE.fullmatch(hostname) is None
+
+def test_trigger_awx_job_uses_shared_session(awx_session):
+    """Test AWX calls go through the shared session"""
+    result = trigger_awx_job('testhost.example.com')
+    
+    assert result['success'] is True
+    assert result['job_id'] == 42
+    launch_url = awx_session.post.call_args[0][0]
+    assert launch_url == 'https://test.example.com/api/v2/job_templates/7/launch/'
+    payload = json.loads(awx_session.post.call_args[1]['data'])
+    assert payload == {
+        'limit': 'testhost.example.com',
+        'extra_vars': {'target_hostname': 'testhost.example.com'}
+    }
+
+def test_trigger_awx_job_caches_template_id(awx_session):
+    """Test template ID lookup is only performed once while cached"""
+    trigger_awx_job('host1.example.com')
+    trigger_awx_job('host2.example.com')
+    
+    assert awx_session.get.call_count == 1
+    assert awx_session.post.call_count == 2
+
+def test_trigger_awx_job_refreshes_stale_template_id(awx_session):
+    """Test a launch 404 for a cached ID evicts it and retries once"""
+    awx_session.get.return_value.json.side_effect = [
+        {'results': [{'id': 7}]},
+        {'results': [{'id': 8}]},
+    ]
+    launched = MagicMock(status_code=201)
+    launched.json.return_value = {'id': 42}
+    stale = MagicMock(status_code=404)
+    awx_session.post.side_effect = [launched, stale, launched]
+    
+    trigger_awx_job('host1.example.com')
+    result = trigger_awx_job('host2.example.com')
+    
+    assert result['success'] is True
+    assert result['job_id'] == 42
+    assert awx_session.get.call_count == 2
+    launch_url = awx_session.post.call_args[0][0]
+    assert launch_url == 'https://test.example.com/api/v2/job_templates/8/launch/'
+
+def test_trigger_awx_job_fresh_template_id_not_retried(awx_session):
+    """Test a launch 404 right after a fresh lookup is not retried"""
+    missing = MagicMock(status_code=404)
+    missing.raise_for_status.side_effect = requests.exceptions.HTTPError('404 Client Error')
+    awx_session.post.return_value = missing
+    
+    result = trigger_awx_job('testhost.example.com')
+    
+    assert result['success'] is False
+    assert awx_session.get.call_count == 1
+    assert awx_session.post.call_count == 1
+
+@patch('ansible_agent.app._AWX_NAME', None)
+def test_trigger_awx_job_without_configured_name(awx_session):
+    """Test nothing is launched when no template or workflow name is set"""
+    result = trigger_awx_job('testhost.example.com')
+    
+    assert result['success'] is False
+    awx_session.get.assert_not_called()
+    awx_session.post.assert_not_called()
+
+@patch('ansible_agent.app.requests.Session')
+def test_preload_awx_id_warms_cache(mock_session_class, awx_session):
+    """Test the startup lookup lets the first request go straight to launch"""
+    preload_session = mock_session_class.return_value.__enter__.return_value
+    preload_session.get.return_value.json.return_value = {'results': [{'id': 7}]}
+    
+    preload_awx_id()
+    assert preload_session.get.call_args.kwargs['timeout'] == 3
+    
+    result = trigger_awx_job('testhost.example.com')
+    
+    assert result['success'] is True
+    awx_session.get.assert_not_called()
+    assert awx_session.post.call_count == 1